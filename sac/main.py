@@ -9,14 +9,17 @@ from datetime import datetime
 import time
 from tensorboardX import SummaryWriter
 import numpy as np
+from numba import njit
+from typing import Tuple
 
 import pdb
 
-from sac.networks import Actor, QNet, VNet
+from sac.networks import Actor, VNet
 
 
 env_name = 'Pendulum-v0'
 n_episodes = 10000
+n_envs = 16
 hidden_size = 256
 replay_buffer_size = 1e6
 train_batch_size = 256
@@ -32,45 +35,72 @@ evaluate_freq = 25
 seed = 0
 load_path = None
 save_freq = 100
+n_graph_warmup_steps = 3
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+
+@njit(cache=True)
+def _ring_insert(states, actions, rewards, next_states, dones, pointer, s, a, r, ns, d):
+    max_len = states.shape[0]
+    for i in range(s.shape[0]):
+        states[pointer] = s[i]
+        actions[pointer] = a[i]
+        rewards[pointer, 0] = r[i]
+        next_states[pointer] = ns[i]
+        dones[pointer, 0] = d[i]
+        pointer = (pointer + 1) % max_len
+    return pointer
+
+
 class ExpReplay:
     def __init__(self):
-        self.states = []
-        self.actions = []
-        self.next_states = []
-        self.rewards = []
-        self.dones = []
+        self.states = None
+        self.actions = None
+        self.next_states = None
+        self.rewards = None
+        self.dones = None
         self.pointer = 0
-        self.max_len = replay_buffer_size
+        self.size = 0
+        self.max_len = int(replay_buffer_size)
+
+    def _allocate(self, state, action):
+        self.states = np.empty((self.max_len, *np.shape(state)), dtype=np.float32)
+        self.actions = np.empty((self.max_len, *np.shape(action)), dtype=np.float32)
+        self.rewards = np.empty((self.max_len, 1), dtype=np.float32)
+        self.next_states = np.empty((self.max_len, *np.shape(state)), dtype=np.float32)
+        self.dones = np.empty((self.max_len, 1), dtype=np.bool_)
+        # tensor views sharing memory with the arrays above, so sampling needs no numpy -> torch conversion
+        self._states_t = torch.from_numpy(self.states)
+        self._actions_t = torch.from_numpy(self.actions)
+        self._rewards_t = torch.from_numpy(self.rewards)
+        self._next_states_t = torch.from_numpy(self.next_states)
+        self._dones_t = torch.from_numpy(self.dones)
 
     def add(self, exp_tuple):
-        if len(self.states) < self.max_len:
-            self.states.append(0)
-            self.actions.append(0)
-            self.rewards.append(0)
-            self.next_states.append(0)
-            self.dones.append(0)
-
-        state, action, reward, next_state, done = exp_tuple
-        self.states[self.pointer] = state
-        self.actions[self.pointer] = action
-        self.rewards[self.pointer] = reward
-        self.next_states[self.pointer] = next_state
-        self.dones[self.pointer] = done
-        self.pointer = int((self.pointer + 1) % self.max_len)
+        self.add_batch([np.expand_dims(x, 0) for x in exp_tuple])
+
+    def add_batch(self, exp_batch):
+        states, actions, rewards, next_states, dones = exp_batch
+        if self.states is None:
+            self._allocate(states[0], actions[0])
+
+        self.pointer = _ring_insert(self.states, self.actions, self.rewards, self.next_states, self.dones, self.pointer,
+                                    np.asarray(states), np.asarray(actions), np.asarray(rewards),
+                                    np.asarray(next_states), np.asarray(dones))
+        self.size = min(self.size + len(states), self.max_len)
 
     def sample(self, batch_size):
-        st_b, ac_b, rew_b, nst_b, dn_b = \
-            zip(*random.sample(list(zip(self.states,self.actions,self.rewards, self.next_states, self.dones)),
-                               batch_size))
-        return st_b, ac_b, rew_b, nst_b, dn_b
+        idx = torch.from_numpy(np.random.randint(0, self.size, batch_size))
+        return self._states_t[idx], self._actions_t[idx], self._rewards_t[idx], self._next_states_t[idx], \
+            self._dones_t[idx]
 
     def __len__(self):
-        return len(self.states)
+        return self.size
 
 
 class Actor(nn.Module):
+    __constants__ = ['logstd_min', 'logstd_max']
+
     def __init__(self, input_size, output_size, action_scale):
         super(Actor, self).__init__()
 
@@ -80,160 +110,319 @@ class Actor(nn.Module):
         self.fc_logstd = nn.Linear(hidden_size, output_size)
 
         self.output_size = output_size
-        self.action_scale = action_scale
+        self.register_buffer('action_scale_t', torch.as_tensor(np.asarray(action_scale), dtype=torch.float32),
+                             persistent=False)
+        self.logstd_min = float(logstd_min)
+        self.logstd_max = float(logstd_max)
 
-    def forward(self, x):
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
 
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         x_m = self.fc_mean(x)
-        x_ls = torch.clamp(self.fc_logstd(x), min=logstd_min, max=logstd_max)
+        x_ls = torch.clamp(self.fc_logstd(x), min=self.logstd_min, max=self.logstd_max)
 
         return x_m, x_ls
 
+    @torch.jit.ignore
     def get_action(self, state):
 
-        state_th = torch.tensor(state).float().to(device)
-        action_mean_th, action_logstd_th = self.forward(state_th)
-        action_th_sampled = torch.tanh(Normal(action_mean_th, torch.exp(action_logstd_th)).sample())*\
-                            torch.tensor(self.action_scale).to(device)
-        action = action_th_sampled.cpu().detach().numpy()
+        with torch.no_grad():
+            state_th = torch.from_numpy(np.asarray(state, dtype=np.float32)).to(self.action_scale_t.device,
+                                                                                 non_blocking=True)
+            action_mean_th, action_logstd_th = self.forward(state_th)
+            action_th_sampled = torch.tanh(action_mean_th + torch.randn_like(action_mean_th)*torch.exp(action_logstd_th))*\
+                                self.action_scale_t
+        action = action_th_sampled.cpu().numpy()
         return action
 
 
-class QNet(nn.Module):
+class TwinQNet(nn.Module):
+    """Both Q networks of the twin critic, stored as stacked weights so that each layer is a single batched matmul.
+    forward(s, a) returns a (2, batch, 1) tensor holding Q1 and Q2. With detach_params=True gradients only flow
+    to the inputs, which is what the policy loss needs.
+    """
     def __init__(self, state_size, action_size):
-        super(QNet, self).__init__()
+        super(TwinQNet, self).__init__()
+
+        self.w1, self.b1 = self._twin_linear(state_size, hidden_size)
+        self.w2, self.b2 = self._twin_linear(hidden_size + action_size, hidden_size)
+        self.w3, self.b3 = self._twin_linear(hidden_size, 1)
+
+    @staticmethod
+    def _twin_linear(n_in, n_out):
+        # same uniform init as nn.Linear
+        bound = 1 / np.sqrt(n_in)
+        weight = nn.Parameter(torch.empty(2, n_in, n_out).uniform_(-bound, bound))
+        bias = nn.Parameter(torch.empty(2, 1, n_out).uniform_(-bound, bound))
+        return weight, bias
+
+    def forward(self, s: torch.Tensor, a: torch.Tensor, detach_params: bool = False) -> torch.Tensor:
+        w1, b1, w2, b2, w3, b3 = self.w1, self.b1, self.w2, self.b2, self.w3, self.b3
+        if detach_params:
+            w1, b1, w2, b2, w3, b3 = w1.detach(), b1.detach(), w2.detach(), b2.detach(), w3.detach(), b3.detach()
+
+        x = F.relu(torch.baddbmm(b1, s.expand(2, -1, -1), w1))
+        x = F.relu(torch.baddbmm(b2, torch.cat((x, a.expand(2, -1, -1)), dim=-1), w2))
+        # single-output value head as an fp32 reduction, which autocast leaves alone, so Q is not rounded to bf16
+        x = torch.sum(x.float()*w3.transpose(1, 2), dim=-1, keepdim=True) + b3
+        return x
 
-        self.fc1 = nn.Linear(state_size, hidden_size)
-        self.fc2 = nn.Linear(hidden_size + action_size, hidden_size)
-        self.fc3 = nn.Linear(hidden_size, 1)
 
-    def forward(self, s, a):
-        x = F.relu(self.fc1(s))
-        x = F.relu(self.fc2(torch.cat((x, a), dim=-1)))
-        x = self.fc3(x)
-        return x
+def make_pinned_batch(state_size, action_size):
+    if device.type != 'cuda':
+        return None
+    shapes = [(state_size, torch.float32), (action_size, torch.float32), (1, torch.float32),
+              (state_size, torch.float32), (1, torch.bool)]
+    return [torch.empty((train_batch_size, size), dtype=dtype, pin_memory=True) for size, dtype in shapes]
+
+
+def load_batch(batch, pinned_batch, copy_stream):
+    if pinned_batch is None:
+        return [tensor.to(device) for tensor in batch]
+
+    # the previous batch may still be in flight out of the staging buffers
+    copy_stream.synchronize()
+    with torch.cuda.stream(copy_stream):
+        batch_th = []
+        for tensor, pinned in zip(batch, pinned_batch):
+            pinned.copy_(tensor)
+            batch_th.append(pinned.to(device, non_blocking=True))
+    torch.cuda.current_stream().wait_stream(copy_stream)
+    for tensor in batch_th:
+        tensor.record_stream(torch.cuda.current_stream())
+    return batch_th
+
+
+def compute_losses(states_th, actions_th, rewards_th, next_states_th, dones_th,
+                   policy, twin_q_net, v_net, v_target_net, use_bf16=False):
+    # the Bellman target stays in fp32; bf16 spacing at Pendulum's value scale is as large as one step's reward
+    with torch.no_grad():
+        V_next_state_vals = v_target_net(next_states_th)
+        Q_target = rewards_th + gamma*V_next_state_vals*(1 - dones_th)
+
+    # bf16 autocast; the weights stay fp32. The autocast weight cache cannot be used inside a CUDA graph
+    with torch.autocast(device_type=states_th.device.type, dtype=torch.bfloat16, enabled=use_bf16,
+                        cache_enabled=False):
+        Q_vals = twin_q_net(states_th, actions_th)
+        V_vals = v_net(states_th)
+        pi_action_means, pi_action_logstd = policy(states_th)
+        # keep the sampling and log-probabilities in fp32
+        pi_action_means, pi_action_logstd = pi_action_means.float(), pi_action_logstd.float()
+        pi_action_stds = torch.exp(pi_action_logstd)
+
+        # argument validation syncs with the host, which is not allowed inside a CUDA graph
+        pi_dist = Normal(pi_action_means, pi_action_stds, validate_args=False)
+        newly_sampled_actions = pi_dist.rsample()
+        newly_sampled_action_log_probs = pi_dist.log_prob(newly_sampled_actions)
+        newly_sampled_Q_vals = twin_q_net(states_th, newly_sampled_actions, True)
+        newly_sampled_Q_minvals = torch.min(newly_sampled_Q_vals[0], newly_sampled_Q_vals[1])
+
+        J_v = F.mse_loss(V_vals, (newly_sampled_Q_minvals - entropy_coeff*newly_sampled_action_log_probs).detach())
+
+        J_q = F.mse_loss(Q_vals[0], Q_target) + F.mse_loss(Q_vals[1], Q_target)
+
+        J_pi = torch.mean(entropy_coeff*newly_sampled_action_log_probs - newly_sampled_Q_minvals)
+    return J_v, J_q, J_pi
+
 
+def step_optimizers(J_v, J_q, J_pi, actor_optimizer, q_net_optimizer, v_net_optimizer):
+    # each loss only reaches its own network's parameters, so one backward pass serves all three optimizers
+    actor_optimizer.zero_grad(set_to_none=True)
+    v_net_optimizer.zero_grad(set_to_none=True)
+    q_net_optimizer.zero_grad(set_to_none=True)
+    (J_v + J_q + J_pi).backward()
+    actor_optimizer.step()
+    v_net_optimizer.step()
+    q_net_optimizer.step()
 
 
-def optimize_model(policy, q1_net, q2_net, v_net, v_target_net, memory, actor_optimizer, q_net_optimizer, v_net_optimizer):
+def bf16_autocast_supported(device):
+    # bf16 autocast only pays off with native bf16 matmuls, i.e. compute capability 8.0+; older GPUs emulate it.
+    # There is no public check for native bf16 on CPU, so CPU stays in fp32
+    return device.type == 'cuda' and torch.cuda.get_device_capability(device)[0] >= 8
+
+
+def make_adam_kwargs(device, capturable=False):
+    # fused Adam is CUDA only; the multi-tensor foreach path is the next best thing on CPU.
+    # capturable keeps Adam's step counters on the device so the update can be recorded into a CUDA graph;
+    # it costs a little in eager mode, so only the entry point that captures the update asks for it
+    if device.type == 'cuda':
+        return {'fused': True, 'capturable': capturable}
+    return {'foreach': True}
+
+
+def update_target(v_target_params, v_params):
+    with torch.no_grad():
+        torch._foreach_mul_(v_target_params, 1 - target_smoothing_coeff)
+        torch._foreach_add_(v_target_params, v_params, alpha=target_smoothing_coeff)
+
+
+def sample_batch(memory, pinned_batch, copy_stream):
+    batch = load_batch(memory.sample(train_batch_size), pinned_batch, copy_stream)
+    batch[-1] = batch[-1].float()
+    return batch
+
+
+def capture_train_step(memory, pinned_batch, copy_stream, policy, twin_q_net, v_net, v_target_net,
+                       actor_optimizer, q_net_optimizer, v_net_optimizer, v_params, v_target_params, use_bf16=False):
+    """Records forward, backward and the optimizer steps of one update into a CUDA graph that reads its batch from
+    static tensors. The optimizers have to be created with capturable=True.
+    The n_graph_warmup_steps warmup runs are ordinary training updates, each on a fresh batch and followed by the
+    target update, so the caller should count them.
+    Returns (graph, static_batch, static_losses); static_losses are overwritten by every replay.
+    """
+    static_batch = sample_batch(memory, pinned_batch, copy_stream)
+
+    def train_step():
+        J_v, J_q, J_pi = compute_losses(*static_batch, policy, twin_q_net, v_net, v_target_net, use_bf16)
+        step_optimizers(J_v, J_q, J_pi, actor_optimizer, q_net_optimizer, v_net_optimizer)
+        return J_v, J_q, J_pi
+
+    # warmup has to run on a side stream before capture
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for i in range(n_graph_warmup_steps):
+            if i > 0:
+                for static_tensor, tensor in zip(static_batch, sample_batch(memory, pinned_batch, copy_stream)):
+                    static_tensor.copy_(tensor)
+            train_step()
+            update_target(v_target_params, v_params)
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    train_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(train_graph):
+        static_losses = train_step()
+    return train_graph, static_batch, static_losses
+
+
+def optimize_model(policy, twin_q_net, v_net, v_target_net, memory, actor_optimizer, q_net_optimizer, v_net_optimizer,
+                   pinned_batch=None, copy_stream=None, graphed_step=None, loss_fn=compute_losses, use_bf16=False):
     if len(memory) < train_batch_size:
         return 0, 0, 0  # dummy losses for consistency in presenting results
 
-    st_b, ac_b, rew_b, nst_b, dn_b = memory.sample(train_batch_size)
-    states_th = torch.tensor(st_b).float().to(device)
-    actions_th = torch.tensor(ac_b).to(device)
-    rewards_th = torch.tensor(rew_b).unsqueeze(1).to(device)
-    next_states_th = torch.tensor(nst_b).float().to(device)
-    dones_th = torch.tensor(dn_b).float().unsqueeze(1).to(device)
-
-    Q1_vals = q1_net(states_th, actions_th)
-    Q2_vals = q2_net(states_th, actions_th)
-    V_vals = v_net(states_th)
-    V_next_state_vals = v_target_net(next_states_th)
-    pi_action_means, pi_action_logstd = policy(states_th)
-    pi_action_stds = torch.exp(pi_action_logstd)
-
-    z = Normal(torch.zeros_like(pi_action_means), torch.ones_like(pi_action_stds)).sample()
-    newly_sampled_actions = pi_action_means + z*pi_action_stds
-    newly_sampled_action_log_probs = Normal(pi_action_means, pi_action_stds).log_prob(newly_sampled_actions)
-    newly_sampled_Q1_vals = q1_net(states_th, newly_sampled_actions)
-    newly_sampled_Q2_vals = q2_net(states_th, newly_sampled_actions)
-    newly_sampled_Q_minvals = torch.min(newly_sampled_Q1_vals, newly_sampled_Q2_vals)
-
-    J_v = torch.mean((V_vals - (newly_sampled_Q_minvals.detach() - entropy_coeff*newly_sampled_action_log_probs.detach()))**2)
-    v_net_optimizer.zero_grad()
-    J_v.backward()
-    v_net_optimizer.step()
+    batch = sample_batch(memory, pinned_batch, copy_stream)
 
-    J_q1 = torch.mean((Q1_vals - (rewards_th + gamma*V_next_state_vals*(1-dones_th)))**2)
-    J_q2 = torch.mean((Q2_vals - (rewards_th + gamma * V_next_state_vals * (1 - dones_th))) ** 2)
-    J_q = J_q1 + J_q2
-    q_net_optimizer.zero_grad()
-    J_q.backward()
-    q_net_optimizer.step()
+    if graphed_step is not None:
+        train_graph, static_batch, static_losses = graphed_step
+        for static_tensor, tensor in zip(static_batch, batch):
+            static_tensor.copy_(tensor)
+        train_graph.replay()
+        return static_losses
 
-    J_pi = torch.mean(entropy_coeff*newly_sampled_action_log_probs - newly_sampled_Q_minvals)
-    actor_optimizer.zero_grad()
-    J_pi.backward()
-    actor_optimizer.step()
+    J_v, J_q, J_pi = loss_fn(*batch, policy, twin_q_net, v_net, v_target_net, use_bf16)
+    step_optimizers(J_v, J_q, J_pi, actor_optimizer, q_net_optimizer, v_net_optimizer)
     return J_v, J_q, J_pi
 
 
-def evaluate_episode(env, policy):
+def evaluate_episode(env, policy, render=False):
     done = False
     state = env.reset()
     rew_ep = 0
-    sum_std = 0
+    sum_std = torch.zeros(env.action_space.shape, device=device)
     steps = 0
+    action_scale = env.action_space.high
     while not done:
-        env.render()
-        action_mean_th, action_logstd_th = policy.forward(torch.tensor(state).float().to(device))
+        if render:
+            env.render()
+        with torch.no_grad():
+            action_mean_th, action_logstd_th = policy.forward(torch.tensor(state).float().to(device))
         steps += 1
-        sum_std += torch.exp(action_logstd_th).detach().cpu().numpy()
-        action = torch.tanh(action_mean_th).cpu().detach().numpy()*env.action_space.high
+        sum_std += torch.exp(action_logstd_th)
+        action = torch.tanh(action_mean_th).cpu().numpy()*action_scale
         next_state, reward, done, _ = env.step(action)
         rew_ep += reward
         state = next_state
 
-    print("Evaluation Reward: {}, Average Std: {}".format(rew_ep, sum_std/steps))
+    print("Evaluation Reward: {}, Average Std: {}".format(rew_ep, (sum_std/steps).cpu().numpy()))
     return rew_ep
 
 if __name__ == '__main__':
 
-    env = gym.make(env_name)
+    env = gym.vector.AsyncVectorEnv([lambda: gym.make(env_name) for _ in range(n_envs)])
+    eval_env = gym.make(env_name)
     dir_name = '/tmp/rl_implementations/sac/{}-{}'.format(env_name, datetime.today().strftime("%Y-%d-%b-%H-%M-%S"))
     writer = SummaryWriter(dir_name)
 
     torch.manual_seed(seed)
     random.seed(seed)
+    np.random.seed(seed)
     env.seed(seed)
+    eval_env.seed(seed)
 
     time_start = time.time()
 
-    policy = Actor(env.observation_space.shape[0], env.action_space.shape[0],env.action_space.high).to(device)
-    q1_net = QNet(env.observation_space.shape[0], env.action_space.shape[0]).to(device)
-    q2_net = QNet(env.observation_space.shape[0], env.action_space.shape[0]).to(device)
-    v_net = VNet(env.observation_space.shape[0]).to(device)
-    v_target_net = VNet(env.observation_space.shape[0]).to(device)
+    policy = torch.jit.script(Actor(eval_env.observation_space.shape[0], eval_env.action_space.shape[0],
+                                    eval_env.action_space.high).to(device))
+    twin_q_net = torch.jit.script(TwinQNet(eval_env.observation_space.shape[0],
+                                           eval_env.action_space.shape[0]).to(device))
+    v_net = torch.jit.script(VNet(eval_env.observation_space.shape[0]).to(device))
+    v_target_net = torch.jit.script(VNet(eval_env.observation_space.shape[0]).to(device))
     v_target_net.eval()
     v_target_net.load_state_dict(v_net.state_dict())
-
-    actor_optimizer = optim.Adam(policy.parameters(), lr=lr)
-    q_net_optimizer = optim.Adam([*q1_net.parameters(), *q2_net.parameters()], lr=lr)
-    v_net_optimizer = optim.Adam(v_net.parameters(), lr=lr)
+    v_target_net.requires_grad_(False)
+
+    use_bf16 = bf16_autocast_supported(device)
+    adam_kwargs = make_adam_kwargs(device, capturable=True)
+    actor_optimizer = optim.Adam(policy.parameters(), lr=lr, **adam_kwargs)
+    q_net_optimizer = optim.Adam(twin_q_net.parameters(), lr=lr, **adam_kwargs)
+    v_net_optimizer = optim.Adam(v_net.parameters(), lr=lr, **adam_kwargs)
+    v_params = list(v_net.parameters())
+    v_target_params = list(v_target_net.parameters())
     memory = ExpReplay()
+    pinned_batch = make_pinned_batch(eval_env.observation_space.shape[0], eval_env.action_space.shape[0])
+    copy_stream = torch.cuda.Stream() if pinned_batch is not None else None
+    graphed_step = None
     steps = 0
-
-    for ep in range(n_episodes):
-        state = env.reset()
-        done = False
-        rew_ep = 0
-
-        while not done:
-            steps += 1
-            action = policy.get_action(state)
-            next_state, reward, done, info = env.step(action)
-            rew_ep += reward
-
-            exp_tuple = (state, action, reward_scaling*reward, next_state, done)
-            memory.add(exp_tuple)
-
-            loss = optimize_model(policy, q1_net, q2_net, v_net, v_target_net, memory,
-                                  actor_optimizer, q_net_optimizer, v_net_optimizer)
-
-            for t_par, par in zip(v_target_net.parameters(), v_net.parameters()):
-                t_par.data = par.data*target_smoothing_coeff + t_par.data*(1-target_smoothing_coeff)
-
-            state = next_state
-
-        writer.add_scalar('train/V-loss', loss[0], ep)
-        writer.add_scalar('train/Q-loss', loss[1], ep)
-        writer.add_scalar('train/Pi-loss', loss[2], ep)
-        writer.add_scalar('train/Total loss', sum(loss), ep)
-        writer.add_scalar('train/steps', steps, ep)
-
-        if ep % evaluate_freq == 0:
-            rew_eval = evaluate_episode(env, policy)
-            writer.add_scalar('eval/rewards', rew_eval, ep)
\ No newline at end of file
+    ep = 0
+
+    states = env.reset()
+    rew_eps = np.zeros(n_envs)
+    while ep < n_episodes:
+        steps += n_envs
+        actions = policy.get_action(states)
+        next_states, rewards, dones, infos = env.step(actions)
+        rew_eps += rewards
+
+        # finished envs are reset automatically, so their next state is the first state of the new episode.
+        # That transition is masked out of the Q target by its done flag.
+        memory.add_batch((states, actions, reward_scaling*rewards, next_states, dones))
+
+        # one update per env step, as in the single env loop
+        n_updates = n_envs
+        # on CUDA the whole update is replayed from a graph once there is enough data to capture it.
+        # The warmup updates run during capture count towards this step's updates
+        if graphed_step is None and device.type == 'cuda' and len(memory) >= train_batch_size:
+            graphed_step = capture_train_step(memory, pinned_batch, copy_stream, policy, twin_q_net, v_net,
+                                              v_target_net, actor_optimizer, q_net_optimizer, v_net_optimizer,
+                                              v_params, v_target_params, use_bf16)
+            n_updates = max(n_envs - n_graph_warmup_steps, 0)
+
+        for _ in range(n_updates):
+            loss = optimize_model(policy, twin_q_net, v_net, v_target_net, memory, actor_optimizer, q_net_optimizer,
+                                  v_net_optimizer, pinned_batch, copy_stream, graphed_step, use_bf16=use_bf16)
+            update_target(v_target_params, v_params)
+
+        states = next_states
+
+        if dones.any():
+            finished_envs = np.flatnonzero(dones)
+            for i, env_idx in enumerate(finished_envs):
+                writer.add_scalar('train/rewards', rew_eps[env_idx], ep + i)
+            rew_eps[finished_envs] = 0
+
+            # the losses and step count are shared by every episode that finished on this step, so log them once
+            writer.add_scalar('train/V-loss', loss[0], ep)
+            writer.add_scalar('train/Q-loss', loss[1], ep)
+            writer.add_scalar('train/Pi-loss', loss[2], ep)
+            writer.add_scalar('train/Total loss', sum(loss), ep)
+            writer.add_scalar('train/steps', steps, ep)
+
+            next_ep = ep + len(finished_envs)
+            if any(e % evaluate_freq == 0 for e in range(ep, next_ep)):
+                rew_eval = evaluate_episode(eval_env, policy)
+                writer.add_scalar('eval/rewards', rew_eval, ep)
+            ep = next_ep
+
+    env.close()
@@ -0,0 +1,142 @@
+import gym
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+import random
+from datetime import datetime
+from queue import Empty
+from tensorboardX import SummaryWriter
+import numpy as np
+
+from sac.main import Actor, TwinQNet, ExpReplay, optimize_model, evaluate_episode, make_pinned_batch
+from sac.main import bf16_autocast_supported, make_adam_kwargs, update_target
+from sac.main import env_name, lr, reward_scaling, train_batch_size, evaluate_freq, seed, device
+from sac.networks import VNet
+
+
+n_train_steps = int(1e6)
+publish_freq = 100  # learner steps between policy weight publications
+log_freq = 1000
+transition_queue_size = 10000
+
+
+def run_actor(shared_policy_state, policy_lock, transitions, episode_rewards, stop_event):
+    """Steps the environment with a CPU copy of the policy, refreshing its weights from the learner every episode"""
+    torch.set_num_threads(1)
+    env = gym.make(env_name)
+    env.seed(seed)
+    torch.manual_seed(seed)
+    policy = torch.jit.script(Actor(env.observation_space.shape[0], env.action_space.shape[0], env.action_space.high))
+
+    while not stop_event.is_set():
+        with policy_lock:
+            policy.load_state_dict(shared_policy_state)
+
+        state = env.reset()
+        done = False
+        rew_ep = 0
+        while not done and not stop_event.is_set():
+            action = policy.get_action(state)
+            next_state, reward, done, info = env.step(action)
+            rew_ep += reward
+            transitions.put((state, action, reward_scaling*reward, next_state, done))
+            state = next_state
+
+        episode_rewards.put(rew_ep)
+
+
+if __name__ == '__main__':
+
+    mp.set_start_method('spawn')
+    env = gym.make(env_name)
+    dir_name = '/tmp/rl_implementations/sac_async/{}-{}'.format(env_name,
+                                                                datetime.today().strftime("%Y-%d-%b-%H-%M-%S"))
+    writer = SummaryWriter(dir_name)
+
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    env.seed(seed)
+
+    policy = torch.jit.script(Actor(env.observation_space.shape[0], env.action_space.shape[0],
+                                    env.action_space.high).to(device))
+    twin_q_net = torch.jit.script(TwinQNet(env.observation_space.shape[0], env.action_space.shape[0]).to(device))
+    v_net = torch.jit.script(VNet(env.observation_space.shape[0]).to(device))
+    v_target_net = torch.jit.script(VNet(env.observation_space.shape[0]).to(device))
+    v_target_net.eval()
+    v_target_net.load_state_dict(v_net.state_dict())
+    v_target_net.requires_grad_(False)
+
+    use_bf16 = bf16_autocast_supported(device)
+    # no CUDA graph is captured here, so Adam does not need to be capturable
+    adam_kwargs = make_adam_kwargs(device)
+    actor_optimizer = optim.Adam(policy.parameters(), lr=lr, **adam_kwargs)
+    q_net_optimizer = optim.Adam(twin_q_net.parameters(), lr=lr, **adam_kwargs)
+    v_net_optimizer = optim.Adam(v_net.parameters(), lr=lr, **adam_kwargs)
+    v_params = list(v_net.parameters())
+    v_target_params = list(v_target_net.parameters())
+    memory = ExpReplay()
+    pinned_batch = make_pinned_batch(env.observation_space.shape[0], env.action_space.shape[0])
+    copy_stream = torch.cuda.Stream() if pinned_batch is not None else None
+
+    shared_policy_state = {name: tensor.detach().cpu().clone().share_memory_()
+                           for name, tensor in policy.state_dict().items()}
+    policy_lock = mp.Lock()
+    transitions = mp.Queue(maxsize=transition_queue_size)
+    episode_rewards = mp.Queue()
+    stop_event = mp.Event()
+    actor = mp.Process(target=run_actor,
+                       args=(shared_policy_state, policy_lock, transitions, episode_rewards, stop_event),
+                       daemon=True)
+    actor.start()
+
+    train_steps = 0
+    ep = 0
+    while train_steps < n_train_steps:
+        try:
+            while True:
+                memory.add(transitions.get_nowait())
+        except Empty:
+            pass
+
+        if len(memory) < train_batch_size:
+            memory.add(transitions.get())
+            continue
+
+        loss = optimize_model(policy, twin_q_net, v_net, v_target_net, memory,
+                              actor_optimizer, q_net_optimizer, v_net_optimizer, pinned_batch, copy_stream,
+                              use_bf16=use_bf16)
+        update_target(v_target_params, v_params)
+        train_steps += 1
+
+        if train_steps % publish_freq == 0:
+            with policy_lock:
+                for name, tensor in policy.state_dict().items():
+                    shared_policy_state[name].copy_(tensor)
+
+        if train_steps % log_freq == 0:
+            writer.add_scalar('train/V-loss', loss[0], train_steps)
+            writer.add_scalar('train/Q-loss', loss[1], train_steps)
+            writer.add_scalar('train/Pi-loss', loss[2], train_steps)
+            writer.add_scalar('train/Total loss', sum(loss), train_steps)
+            writer.add_scalar('train/replay_size', len(memory), train_steps)
+
+        try:
+            while True:
+                rew_ep = episode_rewards.get_nowait()
+                writer.add_scalar('train/rewards', rew_ep, ep)
+                if ep % evaluate_freq == 0:
+                    rew_eval = evaluate_episode(env, policy)
+                    writer.add_scalar('eval/rewards', rew_eval, ep)
+                ep += 1
+        except Empty:
+            pass
+
+    stop_event.set()
+    # keep draining so the actor's queue feeder can flush and the process can exit
+    while actor.is_alive():
+        try:
+            transitions.get(timeout=0.1)
+        except Empty:
+            pass
+    actor.join()
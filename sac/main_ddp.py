@@ -0,0 +1,112 @@
+import gym
+import os
+import torch
+import torch.distributed as dist
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
+import random
+from datetime import datetime
+from tensorboardX import SummaryWriter
+import numpy as np
+
+from sac.main import Actor, TwinQNet, ExpReplay, compute_losses, optimize_model, evaluate_episode, make_pinned_batch
+from sac.main import bf16_autocast_supported, make_adam_kwargs, update_target
+from sac.main import env_name, n_episodes, lr, reward_scaling, evaluate_freq, seed
+from sac.networks import VNet
+
+# Launch with: torchrun --nproc_per_node=N -m sac.main_ddp
+# Every rank keeps its own env and replay buffer and samples train_batch_size transitions from it, so the
+# effective batch per update is N * train_batch_size.
+
+# The networks here are eager modules, so the loss can be compiled; Dynamo cannot trace into the TorchScript
+# networks of the other entry points
+compiled_compute_losses = torch.compile(compute_losses, mode="reduce-overhead")
+
+
+if __name__ == '__main__':
+
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if torch.cuda.is_available():
+        # sac.main places tensors on the current cuda device
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+        dist.init_process_group('nccl')
+    else:
+        device = torch.device('cpu')
+        dist.init_process_group('gloo')
+    rank = dist.get_rank()
+    device_ids = [local_rank] if device.type == 'cuda' else None
+
+    env = gym.make(env_name)
+    torch.manual_seed(seed + rank)
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
+    env.seed(seed + rank)
+
+    writer = None
+    if rank == 0:
+        dir_name = '/tmp/rl_implementations/sac_ddp/{}-{}'.format(env_name,
+                                                                  datetime.today().strftime("%Y-%d-%b-%H-%M-%S"))
+        writer = SummaryWriter(dir_name)
+
+    # DDP wraps the eager modules; fusion comes from the torch.compile'd loss in sac.main instead of TorchScript
+    policy = DDP(Actor(env.observation_space.shape[0], env.action_space.shape[0], env.action_space.high).to(device),
+                 device_ids=device_ids)
+    twin_q_net = DDP(TwinQNet(env.observation_space.shape[0], env.action_space.shape[0]).to(device),
+                     device_ids=device_ids)
+    v_net = DDP(VNet(env.observation_space.shape[0]).to(device), device_ids=device_ids)
+    # the target net never receives gradients, so it stays unwrapped and is kept in sync through v_net
+    v_target_net = VNet(env.observation_space.shape[0]).to(device)
+    v_target_net.eval()
+    v_target_net.load_state_dict(v_net.module.state_dict())
+    v_target_net.requires_grad_(False)
+
+    use_bf16 = bf16_autocast_supported(device)
+    # no CUDA graph is captured here, so Adam does not need to be capturable
+    adam_kwargs = make_adam_kwargs(device)
+    actor_optimizer = optim.Adam(policy.parameters(), lr=lr, **adam_kwargs)
+    q_net_optimizer = optim.Adam(twin_q_net.parameters(), lr=lr, **adam_kwargs)
+    v_net_optimizer = optim.Adam(v_net.parameters(), lr=lr, **adam_kwargs)
+    v_params = list(v_net.parameters())
+    v_target_params = list(v_target_net.parameters())
+    memory = ExpReplay()
+    pinned_batch = make_pinned_batch(env.observation_space.shape[0], env.action_space.shape[0])
+    copy_stream = torch.cuda.Stream() if pinned_batch is not None else None
+    steps = 0
+
+    # Pendulum episodes have a fixed length, so every rank performs the same number of updates and the
+    # gradient all-reduces stay matched across ranks
+    for ep in range(n_episodes):
+        state = env.reset()
+        done = False
+        rew_ep = 0
+
+        while not done:
+            steps += 1
+            action = policy.module.get_action(state)
+            next_state, reward, done, info = env.step(action)
+            rew_ep += reward
+
+            exp_tuple = (state, action, reward_scaling*reward, next_state, done)
+            memory.add(exp_tuple)
+
+            loss = optimize_model(policy, twin_q_net, v_net, v_target_net, memory,
+                                  actor_optimizer, q_net_optimizer, v_net_optimizer, pinned_batch, copy_stream,
+                                  loss_fn=compiled_compute_losses, use_bf16=use_bf16)
+
+            update_target(v_target_params, v_params)
+
+            state = next_state
+
+        if rank == 0:
+            writer.add_scalar('train/V-loss', loss[0], ep)
+            writer.add_scalar('train/Q-loss', loss[1], ep)
+            writer.add_scalar('train/Pi-loss', loss[2], ep)
+            writer.add_scalar('train/Total loss', sum(loss), ep)
+            writer.add_scalar('train/steps', steps, ep)
+
+            if ep % evaluate_freq == 0:
+                rew_eval = evaluate_episode(env, policy.module)
+                writer.add_scalar('eval/rewards', rew_eval, ep)
+
+    dist.destroy_process_group()
@@ -59,9 +59,9 @@ class ExpReplay:
         self.pointer = int((self.pointer + 1) % self.max_len)
 
     def sample(self, batch_size):
+        idx = random.sample(range(len(self.states)), batch_size)
         st_b, ac_b, rew_b, nst_b, dn_b = \
-            zip(*random.sample(list(zip(self.states,self.actions,self.rewards, self.next_states, self.dones)),
-                               batch_size))
+            [[buf[i] for i in idx] for buf in (self.states, self.actions, self.rewards, self.next_states, self.dones)]
         return st_b, ac_b, rew_b, nst_b, dn_b
 
     def __len__(self):
@@ -66,10 +66,11 @@ class VNet(nn.Module):
         self.fc2 = nn.Linear(hidden_size, hidden_size)
         self.fc3 = nn.Linear(hidden_size, 1)
 
-    def forward(self, x):
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
 
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
-        x = self.fc3(x)
+        # fc3 as an fp32 reduction rather than a linear layer, so autocast does not round the value to bf16
+        x = torch.sum(x.float()*self.fc3.weight, dim=-1, keepdim=True) + self.fc3.bias
         return x
 